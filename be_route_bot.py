@@ -1,10 +1,18 @@
 import os
+import asyncio
+import concurrent.futures
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import re
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
 from geopy.geocoders import Nominatim
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
-from math import radians, cos, sin, sqrt, atan2
+from math import radians, cos
 
 # Optional Google Maps import
 try:
@@ -12,18 +20,65 @@ try:
 except ImportError:
     googlemaps = None
 
+# Optional Numba import for the compiled route kernels
+try:
+    from numba import njit  # type: ignore
+except ImportError:
+    njit = None
+
 # Environment variables
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 CITY_HINT = os.getenv("CITY_HINT")
 GMAPS_KEY = os.getenv("GOOGLE_MAPS_KEY")
 GEOCODER_PREF = os.getenv("GEOCODER_PREF", "any").lower()
 
-# Initialize geocoders
-geolocator = Nominatim(user_agent="be_route_bot")
-gmaps = googlemaps.Client(key=GMAPS_KEY) if GMAPS_KEY and googlemaps else None
+# Geocoder clients and the worker pools are created by main(), not at import
+# time, because every route worker process re-imports this module
+geolocator = None
+gmaps = None
+geocode_executor = None
+route_executor = None
+# Maximum number of geocoder requests in flight, across all chats
+GEOCODE_CONCURRENCY = 10
+# Nominatim's usage policy allows at most one request per second. Lookups
+# take turns on the lock and sleep out the gap on the event loop, so no
+# geocode_executor thread is held while waiting for a slot.
+NOMINATIM_MIN_DELAY = 1.0
+_nominatim_lock = asyncio.Lock()
+_nominatim_next_start = 0.0
+# Number of geocoded queries kept in memory
+GEOCODE_CACHE_SIZE = 4096
+_geocode_cache = OrderedDict()
+
+# Largest lat/lon span (degrees) for which routes use the equirectangular
+# distance approximation instead of haversine
+FAST_DIST_MAX_SPAN = 1.0
+# Worker processes for the CPU-bound route optimization. They are started
+# with forkserver (spawn where unavailable) because forking the bot process
+# after its geocoding threads exist can deadlock the children.
+ROUTE_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# One single-threaded worker per CPU this process may run on, which can be
+# fewer than os.cpu_count() under cpusets, taskset or systemd CPUAffinity
+ROUTE_WORKERS = (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+)
+
+
+def _new_route_executor():
+    """Start a pool of route worker processes."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=ROUTE_WORKERS, mp_context=ROUTE_MP_CONTEXT
+    )
+
+
+# Number of route distance matrices kept in memory by each route worker
+DIST_CACHE_SIZE = 64
+_dist_cache = OrderedDict()
 
 # Coordinate regex for detecting "lat, lon" input
-coord_rx = re.compile(r"^\s*(-?\d{1,2}\.\d+)[,\s]+(-?\d{1,3}\.\d+)\s*$")
+coord_rx = re.compile(r"(-?\d{1,2}\.\d+)[,\s]+(-?\d{1,3}\.\d+)", re.ASCII)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message and instructions."""
@@ -38,7 +93,7 @@ async def depot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:
         address = " ".join(context.args)
         try:
-            lat, lon = geocode(address)
+            lat, lon = await geocode(address)
         except Exception as e:
             await update.message.reply_text(f"No se pudo geocodificar la dirección: {address}\n{e}")
             return
@@ -52,7 +107,7 @@ async def depot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(f"Depósito establecido en ({lat:.5f}, {lon:.5f}). Envía las direcciones para optimizar.")
 
 
-def geocode(address: str):
+async def geocode(address: str):
     """
     Geocode an address or coordinate string.
 
@@ -64,21 +119,32 @@ def geocode(address: str):
        will attempt to geocode using Google. The order of geocoders can be
        controlled via the GEOCODER_PREF environment variable.
 
+    Coordinates and previously resolved queries are answered on the event
+    loop. Only lookups that need the network run on ``geocode_executor``, and
+    Nominatim lookups first wait for their slot in :func:`_nominatim_slot`.
+
     :param address: The address or coordinate string to geocode.
     :returns: A tuple of (latitude, longitude).
     :raises ValueError: If no geocoder returns a result.
     """
+    address = address.strip()
     # 1. Check coordinates
-    match = coord_rx.match(address)
+    match = coord_rx.fullmatch(address)
     if match:
         lat = float(match.group(1))
         lon = float(match.group(2))
         if -90 <= lat <= 90 and -180 <= lon <= 180:
             return (lat, lon)
-    # 2. Append city hint if needed
-    query = address
-    if CITY_HINT and CITY_HINT.lower() not in address.lower():
-        query = f"{address}, {CITY_HINT}"
+    # 2. Normalize and append city hint if needed
+    query = address.lower()
+    if CITY_HINT and CITY_HINT.lower() not in query:
+        query = f"{query}, {CITY_HINT.lower()}"
+    # Repeat addresses are served from memory. Failed lookups are not
+    # cached, so they are retried on the next call.
+    location = _geocode_cache.get(query)
+    if location is not None:
+        _geocode_cache.move_to_end(query)
+        return location
     # Determine order
     if GEOCODER_PREF == "google":
         order = ["google", "osm"]
@@ -87,83 +153,313 @@ def geocode(address: str):
     else:
         order = ["osm", "google"]
     # Try geocoders
+    loop = asyncio.get_running_loop()
     for which in order:
+        location = None
         if which == "osm":
-            try:
-                location = geolocator.geocode(query, timeout=10)
-            except Exception:
-                location = None
-            if location:
-                return (location.latitude, location.longitude)
+            await _nominatim_slot()
+            location = await loop.run_in_executor(geocode_executor, _osm_lookup, query)
         if which == "google" and gmaps:
-            try:
-                results = gmaps.geocode(query, region="mx")
-            except Exception:
-                results = None
-            if results:
-                loc = results[0]["geometry"]["location"]
-                return (loc["lat"], loc["lng"])
+            location = await loop.run_in_executor(geocode_executor, _google_lookup, query)
+        if location:
+            _geocode_cache[query] = location
+            if len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+                _geocode_cache.popitem(last=False)
+            return location
     raise ValueError("Dirección no encontrada.")
 
 
-def haversine(coord1, coord2):
-    R = 6371.0
-    lat1, lon1 = coord1
-    lat2, lon2 = coord2
-    phi1, phi2 = radians(lat1), radians(lat2)
-    dphi = radians(lat2 - lat1)
-    dlambda = radians(lon2 - lon1)
-    a = sin(dphi / 2)**2 + cos(phi1) * cos(phi2) * sin(dlambda / 2)**2
-    return 2 * R * atan2(sqrt(a), sqrt(1 - a))
+async def _nominatim_slot():
+    """Wait until the next Nominatim request may start."""
+    global _nominatim_next_start
+    loop = asyncio.get_running_loop()
+    async with _nominatim_lock:
+        delay = _nominatim_next_start - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        _nominatim_next_start = loop.time() + NOMINATIM_MIN_DELAY
 
 
-def route_distance(route, points):
-    dist = 0
-    for i in range(len(route) - 1):
-        dist += haversine(points[route[i]], points[route[i + 1]])
-    return dist
+def _osm_lookup(query: str):
+    """Resolve ``query`` with Nominatim, or return None."""
+    try:
+        location = geolocator.geocode(query, timeout=10)
+    except Exception:
+        return None
+    return (location.latitude, location.longitude) if location else None
+
+
+def _google_lookup(query: str):
+    """Resolve ``query`` with Google, or return None."""
+    try:
+        results = gmaps.geocode(query, region="mx")
+    except Exception:
+        return None
+    if not results:
+        return None
+    loc = results[0]["geometry"]["location"]
+    return (loc["lat"], loc["lng"])
+
 
+async def geocode_many(addresses):
+    """
+    Geocode ``addresses`` concurrently with :func:`geocode`.
+
+    There is no batch endpoint: every address is its own request, tried in
+    GEOCODER_PREF order. Network lookups from all chats share
+    ``geocode_executor``, so Google lookups run up to ``GEOCODE_CONCURRENCY``
+    at a time while Nominatim ones stay one second apart.
+
+    Results are returned in input order; failed lookups are returned as the
+    raised exception.
+    """
+    return await asyncio.gather(*(geocode(a) for a in addresses), return_exceptions=True)
 
-def nearest_neighbor(points, start_index=0):
-    unvisited = list(range(len(points)))
+
+def build_dist_matrix(coords):
+    """
+    Build the full N x N haversine distance matrix (km) for ``coords`` at once.
+
+    ``coords`` is an (N, 2) array of latitude/longitude pairs in degrees. The
+    matrix is computed with NumPy broadcasting so every later distance lookup
+    in the route heuristics is a plain array read.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+    phi1, phi2 = lat[:, None], lat[None, :]
+    dphi = phi2 - phi1
+    dlambda = lon[None, :] - lon[:, None]
+    a = np.sin(dphi / 2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2)**2
+    return 2 * 6371.0 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def fast_dist_matrix(coords):
+    """
+    Approximate N x N distance matrix (km) using an equirectangular projection.
+
+    Over city-scale spans it orders distances the same way as the haversine
+    matrix for a fraction of the trigonometry, which is all the route
+    heuristics need.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    km_per_deg = radians(6371.0)
+    y = coords[:, 0] * km_per_deg
+    x = coords[:, 1] * (km_per_deg * cos(radians(coords[:, 0].mean())))
+    return np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :])
+
+
+def nearest_neighbor(dist, start_index=0):
+    visited = np.zeros(len(dist), dtype=bool)
+    visited[start_index] = True
     path = [start_index]
-    unvisited.remove(start_index)
     current = start_index
-    while unvisited:
-        next_idx = min(unvisited, key=lambda i: haversine(points[current], points[i]))
+    for _ in range(len(dist) - 1):
+        row = dist[current].copy()
+        row[visited] = np.inf
+        next_idx = int(row.argmin())
         path.append(next_idx)
-        unvisited.remove(next_idx)
+        visited[next_idx] = True
         current = next_idx
     return path
 
 
-def two_opt(route, points):
-    best = route
+def two_opt(route, dist, eps=1e-9):
+    """
+    Improve ``route`` with 2-opt swaps.
+
+    Each candidate reversal of ``route[i:j]`` is scored by the O(1) change in
+    the two edges it replaces instead of recomputing the whole route length.
+    ``eps`` keeps floating-point noise from being taken as an improvement.
+
+    Stops are examined one at a time: the edge arriving at the stop is tried
+    against every other edge, and the first improving swap is applied right
+    away. A stop whose scan finds nothing gets a "don't-look" bit and is
+    skipped until a swap touches it. A reversal flips the direction of every
+    edge inside the segment, which changes how those edges pair with the
+    rest of the route, so the bits are cleared for the whole reversed range
+    and its two outer endpoints. The search therefore stops at a 2-opt local
+    optimum, like a full rescan would.
+
+    The route is kept as an int64 array and accepted swaps reverse the segment
+    in place, so rejected candidates allocate nothing.
+    """
+    best = np.array(route, dtype=np.int64)
+    n = len(best)
+    pos = np.empty(n, dtype=np.int64)
+    pos[best] = np.arange(n)
+    dont_look = np.zeros(n, dtype=bool)
     improved = True
     while improved:
         improved = False
-        for i in range(1, len(best) - 2):
-            for j in range(i + 1, len(best)):
-                if j - i == 1:
-                    continue
-                new_route = best[:i] + best[i:j][::-1] + best[j:]
-                if route_distance(new_route, points) < route_distance(best, points):
-                    best = new_route
-                    improved = True
-        route = best
+        for city in range(n):
+            if dont_look[city]:
+                continue
+            found = False
+            # Edge k joins best[k - 1] and best[k]; the first stop has none
+            k = pos[city]
+            if k >= 1:
+                for m in range(1, n):
+                    if abs(m - k) < 2:
+                        continue
+                    i, j = min(k, m), max(k, m)
+                    a, b, c, d = best[i - 1], best[i], best[j - 1], best[j]
+                    delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+                    if delta < -eps:
+                        best[i:j] = best[i:j][::-1]
+                        pos[best[i:j]] = np.arange(i, j)
+                        dont_look[best[i - 1:j + 1]] = False
+                        improved = found = True
+                        break
+            if not found:
+                dont_look[city] = True
     return best
 
 
-def build_maps_links(points):
+def _nn_numba(dist, start):
+    n = dist.shape[0]
+    route = np.empty(n, dtype=np.int64)
+    visited = np.zeros(n, dtype=np.bool_)
+    route[0] = start
+    visited[start] = True
+    current = start
+    for k in range(1, n):
+        best_d = np.inf
+        best_idx = -1
+        for i in range(n):
+            if not visited[i] and dist[current, i] < best_d:
+                best_d = dist[current, i]
+                best_idx = i
+        route[k] = best_idx
+        visited[best_idx] = True
+        current = best_idx
+    return route
+
+
+def _first_move_numba(route, dist, k, eps):
+    # Smallest m such that swapping edges k and m improves the route, or -1
+    n = route.shape[0]
+    for m in range(1, n):
+        if abs(m - k) < 2:
+            continue
+        i, j = min(k, m), max(k, m)
+        a, b, c, d = route[i - 1], route[i], route[j - 1], route[j]
+        if dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d] < -eps:
+            return m
+    return -1
+
+
+def _two_opt_numba(route, dist, eps):
+    # Same search as two_opt(), on an int64 route reversed in place
+    n = route.shape[0]
+    pos = np.empty(n, dtype=np.int64)
+    for idx in range(n):
+        pos[route[idx]] = idx
+    dont_look = np.zeros(n, dtype=np.bool_)
+    improved = True
+    while improved:
+        improved = False
+        for city in range(n):
+            if dont_look[city]:
+                continue
+            k = pos[city]
+            m = -1
+            if k >= 1:
+                m = _first_move_numba(route, dist, k, eps)
+            if m < 0:
+                dont_look[city] = True
+                continue
+            i, j = min(k, m), max(k, m)
+            lo, hi = i, j - 1
+            while lo < hi:
+                route[lo], route[hi] = route[hi], route[lo]
+                pos[route[lo]] = lo
+                pos[route[hi]] = hi
+                lo += 1
+                hi -= 1
+            for idx in range(i - 1, j + 1):
+                dont_look[route[idx]] = False
+            improved = True
+    return route
+
+
+if njit:
+    _nn_numba = njit(cache=True)(_nn_numba)
+    _first_move_numba = njit(cache=True)(_first_move_numba)
+    _two_opt_numba = njit(cache=True)(_two_opt_numba)
+
+
+def route_dist_matrix(coords):
+    """
+    Return the distance matrix used to optimize the route through ``coords``.
+
+    Stops that fit within ``FAST_DIST_MAX_SPAN`` degrees use the
+    equirectangular approximation, anything wider the haversine matrix. The
+    last ``DIST_CACHE_SIZE`` matrices are kept, keyed on the coordinates, so
+    resubmitting the same stop list skips the rebuild. Cached matrices are
+    read-only.
+
+    The cache lives in the calling process. Route workers are
+    single-threaded, so it needs no lock, and a repeated route only hits it
+    when it lands on the same worker.
+    """
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    key = hashlib.blake2b(coords.tobytes(), digest_size=16).digest()
+    dist = _dist_cache.get(key)
+    if dist is not None:
+        _dist_cache.move_to_end(key)
+        return dist
+    if np.ptp(coords, axis=0).max() <= FAST_DIST_MAX_SPAN:
+        dist = fast_dist_matrix(coords)
+    else:
+        dist = build_dist_matrix(coords)
+    dist.flags.writeable = False
+    _dist_cache[key] = dist
+    if len(_dist_cache) > DIST_CACHE_SIZE:
+        _dist_cache.popitem(last=False)
+    return dist
+
+
+def optimize_route(coords, start_index=0):
+    """
+    Return the visiting order for ``coords`` starting at ``start_index``.
+
+    Builds the distance matrix with :func:`route_dist_matrix` and runs
+    nearest neighbor followed by 2-opt, using the Numba-compiled kernels when
+    Numba is installed and the pure Python implementations otherwise.
+    """
+    dist = route_dist_matrix(coords)
+    if njit:
+        route = _nn_numba(dist, start_index)
+        return _two_opt_numba(route, dist, 1e-9).tolist()
+    route = nearest_neighbor(dist, start_index)
+    return two_opt(route, dist).tolist()
+
+
+def _replace_route_executor(broken):
+    """
+    Swap a broken route pool for a new one.
+
+    A worker that dies (killed for memory, a crash in a kernel) breaks the
+    whole pool, so every later submit would fail. The pool is only replaced
+    if no other chat has replaced it already.
+    """
+    global route_executor
+    if route_executor is broken:
+        route_executor = _new_route_executor()
+    broken.shutdown(wait=False)
+
+
+def build_maps_links(coords):
     links = []
     base = "https://www.google.com/maps/dir/?api=1"
     chunk_size = 10
-    for idx in range(0, len(points), chunk_size):
-        chunk = points[idx:idx + chunk_size]
-        origin = f"{chunk[0][0]},{chunk[0][1]}"
-        dest = f"{chunk[-1][0]},{chunk[-1][1]}"
+    for idx in range(0, len(coords), chunk_size):
+        chunk = coords[idx:idx + chunk_size]
+        origin = f"{chunk[0, 0]},{chunk[0, 1]}"
+        dest = f"{chunk[-1, 0]},{chunk[-1, 1]}"
         if len(chunk) > 2:
-            waypoints = "|".join([f"{p[0]},{p[1]}" for p in chunk[1:-1]])
+            waypoints = "|".join(map("{0[0]},{0[1]}".format, chunk[1:-1]))
             url = f"{base}&origin={origin}&destination={dest}&waypoints={waypoints}"
         else:
             url = f"{base}&origin={origin}&destination={dest}"
@@ -182,32 +478,66 @@ async def handle_addresses(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # Add depot first
     points.append(context.user_data["depot"])
     labels.append("Depósito")
-    # Geocode each provided line
-    for line in lines:
-        try:
-            lat, lon = geocode(line)
-            points.append((lat, lon))
-            labels.append(line)
-        except Exception as e:
-            await update.message.reply_text(f"No se pudo geocodificar {line}: {e}")
-            return
-    route = nearest_neighbor(points, 0)
-    optimized = two_opt(route, points)
-    order_lines = []
-    for idx, stop_idx in enumerate(optimized):
-        order_lines.append(f"{idx + 1}. {labels[stop_idx]}")
-    response = "Orden de paradas optimizado:\n" + "\n".join(order_lines)
-    maps_links = build_maps_links([points[i] for i in optimized])
-    for i, link in enumerate(maps_links):
-        response += f"\n\nTramo {i + 1}: {link}"
-    await update.message.reply_text(response)
+    # Geocode all provided lines concurrently, keeping the ones that resolve
+    results = await geocode_many(lines)
+    failed = []
+    for line, result in zip(lines, results):
+        if isinstance(result, Exception):
+            failed.append(f"- {line}: {result}")
+            continue
+        points.append(result)
+        labels.append(line)
+    if failed:
+        await update.message.reply_text(
+            "No se pudieron geocodificar las siguientes direcciones:\n" + "\n".join(failed)
+        )
+    if len(points) == 1:
+        return
+    # Pack the stops into a contiguous (N, 2) float64 array for the kernels
+    coords = np.fromiter(
+        itertools.chain.from_iterable(points), dtype=np.float64, count=2 * len(points)
+    ).reshape(-1, 2)
+    # Run the route optimization in a worker process so other chats stay
+    # responsive; only the (N, 2) coordinates are sent to it
+    loop = asyncio.get_running_loop()
+    executor = route_executor
+    try:
+        optimized = await loop.run_in_executor(executor, optimize_route, coords, 0)
+    except BrokenProcessPool:
+        logging.exception("Route worker process died")
+        _replace_route_executor(executor)
+        await update.message.reply_text(
+            "No se pudo optimizar la ruta porque el proceso de cálculo falló. Inténtalo de nuevo."
+        )
+        return
+    except Exception as e:
+        logging.exception("Route optimization failed")
+        await update.message.reply_text(f"No se pudo optimizar la ruta: {e}")
+        return
+    # Labels are the only per-stop Python walk; the coordinates are
+    # reordered with a single vectorized gather
+    order_lines = [f"{idx}. {labels[stop_idx]}" for idx, stop_idx in enumerate(optimized, 1)]
+    ordered_coords = coords[optimized]
+    parts = ["Orden de paradas optimizado:\n", "\n".join(order_lines)]
+    for i, link in enumerate(build_maps_links(ordered_coords), 1):
+        parts.append(f"\n\nTramo {i}: {link}")
+    await update.message.reply_text("".join(parts))
 
 
 def main():
+    global geolocator, gmaps, geocode_executor, route_executor
     logging.basicConfig(level=logging.INFO)
     if not TOKEN:
         raise RuntimeError("Debe definir la variable de entorno TELEGRAM_TOKEN.")
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Initialize geocoders and worker pools
+    geolocator = Nominatim(user_agent="be_route_bot")
+    gmaps = googlemaps.Client(key=GMAPS_KEY) if GMAPS_KEY and googlemaps else None
+    geocode_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=GEOCODE_CONCURRENCY, thread_name_prefix="geocode"
+    )
+    route_executor = _new_route_executor()
+    # Process updates concurrently so one user's long route doesn't stall others
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(True).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("depot", depot))
     app.add_handler(MessageHandler(filters.LOCATION, depot))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import be_route_bot as bot
+
+SIZES = [2, 3, 4, 5, 12, 30, 60]
+
+
+def random_dist(n, seed):
+    rng = np.random.default_rng(seed)
+    coords = rng.random((n, 2)) * 0.2 + [20.5, -100.4]
+    return bot.fast_dist_matrix(coords)
+
+
+def is_two_opt_optimal(route, dist, eps=1e-9):
+    # Edges i and j join route[i - 1], route[i] and route[j - 1], route[j]
+    n = len(route)
+    for i in range(1, n):
+        for j in range(i + 2, n):
+            a, b, c, d = route[i - 1], route[i], route[j - 1], route[j]
+            if dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d] < -eps:
+                return False
+    return True
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("seed", range(5))
+def test_two_opt_reaches_local_optimum(n, seed):
+    dist = random_dist(n, seed)
+    route = bot.two_opt(bot.nearest_neighbor(dist, 0), dist)
+    assert sorted(route.tolist()) == list(range(n))
+    assert route[0] == 0
+    assert is_two_opt_optimal(route, dist)
+
+
+@pytest.mark.skipif(bot.njit is None, reason="Numba is not installed")
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("seed", range(5))
+def test_numba_kernels_match_python(n, seed):
+    dist = random_dist(n, seed)
+    nn = bot.nearest_neighbor(dist, 0)
+    nn_numba = bot._nn_numba(dist, 0)
+    assert nn_numba.tolist() == nn
+    route = bot.two_opt(nn, dist)
+    route_numba = bot._two_opt_numba(nn_numba, dist, 1e-9)
+    assert route_numba.tolist() == route.tolist()